@@ -1,15 +1,17 @@
-import json
 import logging
 import os
 import sys
-from collections import namedtuple
-from io import BytesIO
-from urllib.parse import urlencode, urlunsplit
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from urllib.parse import urlencode
 
-import pyproj
+import cftime
+import netCDF4
+import orjson
+import pandas
 import requests
-import xarray
 from osgeo import gdal
+from requests.adapters import HTTPAdapter, Retry
 from requests.exceptions import HTTPError
 from s3fs import S3FileSystem
 
@@ -17,6 +19,11 @@ from s3fs import S3FileSystem
 os.environ["AWS_REQUEST_CHECKSUM_CALCULATION"] = "when_required"
 os.environ["AWS_RESPONSE_CHECKSUM_VALIDATION"] = "when_required"
 
+# GDAL performance tuning: cached VSI reads, the block cache size is set per worker process (cf. configure_worker)
+gdal.SetConfigOption("VSI_CACHE", "TRUE")
+gdal.SetConfigOption("GDAL_TIFF_OVR_BLOCKSIZE", "512")
+gdal.SetConfigOption("CPL_VSIL_CURL_ALLOWED_EXTENSIONS", ".tif,.nc")
+
 logging.basicConfig(
     level=logging.INFO,
     stream=sys.stdout,
@@ -24,6 +31,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# GDAL block cache (in MB) shared by all worker processes
+GDAL_CACHEMAX_MB = 1024
+
+# Size of the chunks in which the DMI API response is written to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Connect and read timeouts (in seconds) for requests to the DMI API
+DOWNLOAD_TIMEOUT = (5, 300)
+
+# PREDICTOR=YES lets the COG driver choose the floating point predictor for float data.
+# Compression runs single-threaded, the bands are already encoded concurrently in a thread pool.
+COG_CREATION_OPTIONS = [
+    "COMPRESS=ZSTD",
+    "LEVEL=9",
+    "PREDICTOR=YES",
+    "BLOCKSIZE=512",
+    "BIGTIFF=IF_SAFER",
+]
+
 # see https://opendatadocs.dmi.govcloud.dk/Data/Forecast_Data_Weather_Model_HARMONIE_DINI_IG
 LCC_DMI_WKT = """PROJCRS["DMI HARMONIE DINI lambert projection",
 BASEGEOGCRS["DMI HARMONIE DINI lambert CRS",
@@ -64,71 +90,214 @@ CS[Cartesian,2],
         LENGTHUNIT["Metre",1]]]"""
 
 
+@lru_cache(maxsize=4)
+def _get_s3(endpoint_url, key, secret):
+    # single place to create the filesystem, fsspec itself already caches instances by their constructor arguments
+    return S3FileSystem(endpoint_url=endpoint_url, key=key, secret=secret)
+
+
 def delete_outdated_forecasts(bucket_path, endpoint_url, key, secret):
     logger.debug(f"Delete path {bucket_path} recursively.")
-    s3 = S3FileSystem(endpoint_url=endpoint_url, key=key, secret=secret)
+    s3 = _get_s3(endpoint_url, key, secret)
     try:
+        # s3fs lists the keys page-wise and removes them with batched DeleteObjects calls (up to 1000 keys each)
         s3.rm(bucket_path, recursive=True)
     except FileNotFoundError as err:
         logger.debug(err)
 
 
-def netcdf_to_cog(input_file, output_file):
-    dataset = gdal.Open(input_file)
-    options = gdal.TranslateOptions(format="COG", creationOptions=["COMPRESS=LZW"], outputSRS="EPSG:4326")
-    gdal.Translate(output_file, dataset, options=options)
+@lru_cache(maxsize=1)
+def _get_session():
+    # keep connections to the DMI API alive between requests and retry on transient server errors
+    session = requests.Session()
+    retries = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        # return the last response so that raise_for_status() raises an HTTPError
+        raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+    return session
+
+
+def download_to_file(url, local_file):
+    # stream the response in chunks to keep the memory footprint independent of the file size
+    with _get_session().get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        with open(local_file, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
+
+def read_times(nc_file):
+    # only the time coordinate is needed, the data itself is read by GDAL
+    with netCDF4.Dataset(nc_file, "r") as nc:
+        nc.set_auto_mask(False)
+        time = nc.variables["time"]
+        return cftime.num2date(
+            time[:],
+            time.units,
+            calendar=getattr(time, "calendar", "standard"),
+            only_use_cftime_datetimes=False,
+            only_use_python_datetimes=True,
+        )
+
+
+def format_times(times):
+    # e.g. 2025-01-01 12:00:00 -> 20250101T120000
+    return pandas.to_datetime(times).strftime("%Y%m%dT%H%M%S").tolist()
+
+
+def netcdf_to_cog(input_file, output_file, band, src_srs=None):
+    # pass the file name instead of a shared dataset handle, GDAL datasets must not be used by several threads
+    if src_srs is None:
+        options = gdal.TranslateOptions(
+            format="COG", bandList=[band], creationOptions=COG_CREATION_OPTIONS, outputSRS="EPSG:4326"
+        )
+        dataset = gdal.Translate(output_file, input_file, options=options)
+    else:
+        # reproject and encode the COG in a single GDAL pass
+        options = gdal.WarpOptions(
+            format="COG",
+            srcBands=[band],
+            creationOptions=COG_CREATION_OPTIONS,
+            srcSRS=src_srs,
+            dstSRS="EPSG:4326",
+            # like rio.reproject, mark cells outside the source grid as NaN instead of 0 (a valid precipitation value)
+            dstNodata=float("nan"),
+        )
+        dataset = gdal.Warp(output_file, input_file, options=options)
+    if dataset is None:
+        # GDAL does not raise by default, e.g. a failed write to /vsis3/ only shows up as missing dataset
+        raise RuntimeError(f"Could not write {output_file}: {gdal.GetLastErrorMsg()}")
     dataset = None
 
 
-def reproject_from_lambert(xarray_dataset, crs_to="epsg:4326"):
-    crs_from = pyproj.CRS.from_wkt(LCC_DMI_WKT)
-    xarray_dataset.rio.write_crs(crs_from, inplace=True)
-    xarray_dataset = xarray_dataset.rio.reproject(crs_to)
-    return xarray_dataset
+def _endpoint_host(endpoint_url):
+    return endpoint_url.removeprefix("https://").removeprefix("http://")
 
 
-def transform_cog_to_single_bands_and_upload_to_bucket(
-    cog_file,
+def transform_netcdf_to_single_band_cogs_and_upload_to_bucket(
+    nc_file,
     folder_name,
-    times,
+    time_strs,
     bucket_name=None,
     bucket_path=None,
     endpoint=None,
-    key=None,
-    secret=None,
     upload=False,
+    src_srs=None,
+    band_workers=1,
 ):
-    dataset = gdal.Open(cog_file)
-    forecasts = {}
-    for band, t in enumerate(times):
-        time_str = str(t).split(".")[0].replace("-", "").replace(":", "")
-        output_file = os.path.join(folder_name, time_str + ".tif")
-        options = gdal.TranslateOptions(bandList=[band + 1], creationOptions=["BIGTIFF=YES"])
-        gdal.Translate(output_file, dataset, options=options)
-        if upload:
-            upload_to_bucket(
-                output_file,
-                f"{bucket_name}/{bucket_path}/{os.path.basename(output_file)}",
-                endpoint,
-                key,
-                secret,
-            )
-            forecasts[time_str] = (
-                f"https://{bucket_name}.{endpoint.removeprefix('https://')}/{bucket_path}/{os.path.basename(output_file)}"
-            )
-            if band % 10 == 0:
-                logger.info(f"Uploaded {band} of {len(times)} files.")
-    dataset = None
-    return forecasts
+    # when uploading, GDAL writes the COGs directly to the bucket (cf. configure_gdal_s3)
+    output_folder = f"/vsis3/{bucket_name}/{bucket_path}" if upload else folder_name
+    with ThreadPoolExecutor(max_workers=band_workers) as executor:
+        futures = [
+            executor.submit(netcdf_to_cog, nc_file, f"{output_folder}/{time_str}.tif", band + 1, src_srs)
+            for band, time_str in enumerate(time_strs)
+        ]
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                if upload and done % 10 == 0:
+                    logger.info(f"Uploaded {done} of {len(time_strs)} files.")
+        except Exception:
+            # fail fast instead of encoding and uploading all queued bands first
+            executor.shutdown(cancel_futures=True)
+            raise
+    if not upload:
+        return {}
+    # build the result in time order, consumers of forecasts.json rely on the order of the keys
+    endpoint_host = _endpoint_host(endpoint)
+    return {time_str: f"https://{bucket_name}.{endpoint_host}/{bucket_path}/{time_str}.tif" for time_str in time_strs}
+
+
+def configure_gdal_s3(endpoint_url, key, secret):
+    gdal.SetConfigOption("AWS_S3_ENDPOINT", _endpoint_host(endpoint_url))
+    gdal.SetConfigOption("AWS_HTTPS", "NO" if endpoint_url.startswith("http://") else "YES")
+    gdal.SetConfigOption("AWS_ACCESS_KEY_ID", key)
+    gdal.SetConfigOption("AWS_SECRET_ACCESS_KEY", secret)
+    # address the bucket as part of the path, like s3fs does
+    gdal.SetConfigOption("AWS_VIRTUAL_HOSTING", "FALSE")
+
+
+def configure_worker(gdal_cachemax_mb, upload, endpoint_url, key, secret):
+    # SetCacheMax applies regardless of whether the block cache has already been used in this process
+    gdal.SetCacheMax(gdal_cachemax_mb * 1024 * 1024)
+    if upload:
+        configure_gdal_s3(endpoint_url, key, secret)
 
 
 def upload_to_bucket(local_file, bucket_file, endpoint_url, key, secret):
     logger.debug(f"Try to upload {local_file} to {bucket_file}.")
-    s3 = S3FileSystem(endpoint_url=endpoint_url, key=key, secret=secret)
-    with open(local_file, "rb") as f:
-        with s3.open(bucket_file, "wb") as s3_file:
-            s3_file.write(f.read())
-            logger.debug("Upload succeeded.")
+    s3 = _get_s3(endpoint_url, key, secret)
+    # files smaller than twice the s3fs chunksize (100 MB by default) are read at once and sent with a single PUT,
+    # larger files are uploaded in parts
+    s3.put(local_file, bucket_file)
+    logger.debug("Upload succeeded.")
+
+
+def ingest_parameter(
+    parameter,
+    url,
+    base_data_dir,
+    bucket_name,
+    bucket_path,
+    bucket_endpoint,
+    bucket_key,
+    bucket_secret,
+    upload,
+    src_srs=None,
+    band_workers=1,
+):
+    logger.info(f"Start ingesting data for parameter '{parameter}'.")
+    bucket_path_full = f"{bucket_name}/{bucket_path}"
+    forecast_json_bucket_path = bucket_path_full + "/forecasts.json"
+    # file names are suffixed by the parameter to avoid collisions between the worker processes
+    download_filename = os.path.join(base_data_dir, f"download_{parameter}.nc")
+    forecast_json_filename = os.path.join(base_data_dir, f"forecasts_{parameter}.json")
+    cog_folder = os.path.join(base_data_dir, parameter)
+    if not upload and not os.path.exists(cog_folder):
+        os.makedirs(cog_folder)
+
+    try:
+        try:
+            logger.info("Request data from DMI API.")
+            download_to_file(url, download_filename)
+        except HTTPError as err:
+            logger.error(err)
+            return
+        delete_outdated_forecasts(bucket_path_full, bucket_endpoint, bucket_key, bucket_secret)
+        logger.info("Transform NetCDF bands (time slices) to COGs and upload them to bucket.")
+        # GDAL reads the downloaded NetCDF directly, reprojection (if any) happens while writing the COGs
+        data = transform_netcdf_to_single_band_cogs_and_upload_to_bucket(
+            download_filename,
+            cog_folder,
+            format_times(read_times(download_filename)),
+            bucket_name,
+            bucket_path,
+            bucket_endpoint,
+            upload,
+            src_srs,
+            band_workers,
+        )
+        with open(forecast_json_filename, "wb") as fp:
+            fp.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        upload_to_bucket(
+            forecast_json_filename,
+            forecast_json_bucket_path,
+            bucket_endpoint,
+            bucket_key,
+            bucket_secret,
+        )
+    finally:
+        # also clean up after a failed parameter, the files may be partially written or missing
+        for local_file in (download_filename, forecast_json_filename):
+            try:
+                if os.path.exists(local_file):
+                    os.remove(local_file)
+            except OSError as err:
+                logger.warning(err)
 
 
 if __name__ == "__main__":
@@ -144,90 +313,57 @@ if __name__ == "__main__":
     collection = os.getenv("COLLECTION", "dkss_if")
     parameters = os.getenv("PARAMETERS", "sea-mean-deviation")
     bbox = os.getenv("BBOX", "11.5,55.5,12.2,56.1")
+    # bands written concurrently per parameter, each band write mostly waits on the PUT to the bucket
+    band_workers = int(os.getenv("BAND_WORKERS", "16"))
     # Fixed parameters
     netloc = "dmigw.govcloud.dk"
     url_base_path = "v1/forecastedr/collections"
     request_type = "cube"
     out_format = "NetCDF"  # the API is case-sensitive!
     base_data_dir = "/app/data"
-    nc_filename = os.path.join(base_data_dir, "temp.nc")
-    cog_filename = os.path.join(base_data_dir, "temp.tif")
-    forecast_json_filename = os.path.join(base_data_dir, "forecasts.json")
-
-    for parameter in parameters.split(","):
-        logger.info(f"Start ingesting data from collection '{collection}' for parameter '{parameter}'.")
-        bucket_path = f"{bucket_base_path}/{collection}/{parameter}"
-        bucket_path_full = f"{bucket_name}/{bucket_path}"
-        forecast_json_bucket_path = bucket_path_full + "/forecasts.json"
-        if not os.path.exists(base_data_dir):
-            os.makedirs(base_data_dir)
-
-        Parts = namedtuple(
-            typename="Components",
-            field_names=["scheme", "netloc", "path", "query", "fragment"],
-        )
 
-        if collection.startswith("harmonie"):
-            crs = "native"
-        else:
-            crs = "crs84"
-
-        query_params = {
-            "api-key": dmi_api_key,
-            "crs": crs,
-            "parameter-name": parameter,
-            "bbox": bbox,
-            "f": out_format,
-        }
-
-        url = urlunsplit(
-            Parts(
-                scheme="https",
-                netloc=netloc,
-                path=f"{url_base_path}/{collection}/{request_type}",
-                query=urlencode(query_params),
-                fragment="",
-            )
-        )
-        try:
-            logger.info("Request data from DMI API.")
-            response = requests.get(url)
-            response.raise_for_status()
-        except HTTPError as err:
-            logger.error(err)
-        else:
-            delete_outdated_forecasts(bucket_path_full, bucket_endpoint, bucket_key, bucket_secret)
-            ds = xarray.open_dataset(BytesIO(response.content))
-            if collection.startswith("harmonie"):
-                ds = reproject_from_lambert(ds)
-            logger.info("Save data to NetCDF.")
-            ds.to_netcdf(nc_filename)
-            logger.info("Transform NetCDF to COG.")
-            netcdf_to_cog(nc_filename, cog_filename)
-            logger.info("Split COG into bands (time slices) and upload them to bucket.")
-            data = transform_cog_to_single_bands_and_upload_to_bucket(
-                cog_filename,
+    if collection.startswith("harmonie"):
+        crs = "native"
+    else:
+        crs = "crs84"
+
+    base_url = f"https://{netloc}/{url_base_path}/{collection}/{request_type}"
+    query_params = {
+        "api-key": dmi_api_key,
+        "crs": crs,
+        "bbox": bbox,
+        "f": out_format,
+    }
+
+    if not os.path.exists(base_data_dir):
+        os.makedirs(base_data_dir)
+
+    logger.info(f"Start ingesting data from collection '{collection}' for parameters '{parameters}'.")
+    parameter_list = parameters.split(",")
+    # parameters are independent of each other, so each one is ingested in its own process. The GDAL block cache
+    # is split between the processes.
+    process_count = min(len(parameter_list), os.cpu_count() or 1)
+    with ProcessPoolExecutor(
+        max_workers=process_count,
+        initializer=configure_worker,
+        initargs=(GDAL_CACHEMAX_MB // process_count, upload, bucket_endpoint, bucket_key, bucket_secret),
+    ) as executor:
+        futures = [
+            executor.submit(
+                ingest_parameter,
+                parameter,
+                f"{base_url}?{urlencode({**query_params, 'parameter-name': parameter})}",
                 base_data_dir,
-                ds.time.values,
                 bucket_name,
-                bucket_path,
+                f"{bucket_base_path}/{collection}/{parameter}",
                 bucket_endpoint,
                 bucket_key,
                 bucket_secret,
                 upload,
+                LCC_DMI_WKT if collection.startswith("harmonie") else None,
+                band_workers,
             )
-            with open(forecast_json_filename, "w", encoding="utf-8") as fp:
-                json.dump(data, fp, indent=4)
-            upload_to_bucket(
-                forecast_json_filename,
-                forecast_json_bucket_path,
-                bucket_endpoint,
-                bucket_key,
-                bucket_secret,
-            )
-            try:
-                os.remove(nc_filename)
-                os.remove(cog_filename)
-                os.remove(forecast_json_filename)
-            except Exception as err:
-                logger.warning(err)
+            for parameter in parameter_list
+        ]
+        for future in as_completed(futures):
+            future.result()